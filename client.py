@@ -9,6 +9,7 @@ center_axle = LargeMotor(OUTPUT_A)
 rear_wheel_left = LargeMotor(OUTPUT_B)
 rear_wheel_right = LargeMotor(OUTPUT_C)
 
+# Output: brick times at which the rear wheels started and stopped moving
 def move_joints(command):
     direction, duration, speed = command
     direction = -direction  # Reverse the sign because center axle motor spins the other way
@@ -19,12 +20,14 @@ def move_joints(command):
     center_axle.on_for_degrees(SpeedPercent(100), direction)  # Turn to angle to the marker
 
     # Move the rear wheels simultaneously
+    started = time.time()
     rear_wheel_left.on_for_seconds(SpeedPercent(speed), duration, block=False)   # Push forward (go straight)
     rear_wheel_right.on_for_seconds(SpeedPercent(speed), duration, block=False)  # Push forward (go straight)
 
     # Wait for the rear wheels to finish their movements
     rear_wheel_left.wait_while('running')
     rear_wheel_right.wait_while('running')
+    finished = time.time()
 
     # Reset center axle motor rotation back to 0 position
     if direction != 0:
@@ -34,12 +37,18 @@ def move_joints(command):
 
     time.sleep(0.2)  # To account for delay when the camera feeds are not in sync
 
+    return started, finished
 
-def execute(data):
+
+# Format of the data: "direction,duration,speed", optionally followed by ",trace_id" for latency tracing
+def execute(data, received):
     raw_command = data.split(',')
-    command = [float(value) for value in raw_command]
-    move_joints(command)
-    client.sendDone()
+    command = [float(value) for value in raw_command[:3]]
+    started, finished = move_joints(command)
+    if len(raw_command) > 3:
+        client.sendDone(raw_command[3], received, started, finished)
+    else:
+        client.sendDone()
     
 
 
@@ -56,14 +65,22 @@ class Client:
     def pollData(self):
         print("\nWaiting for Data")
         data = self.s.recv(128).decode("UTF-8")
+        received = time.time()
         if data:
             print("Data Received")
-            execute(data)
+            execute(data, received)
             return data
     
     # Sends a message to the server letting it know that the movement of the motors was executed without any inconvenience.
-    def sendDone(self):
-        self.s.send("DONE".encode("UTF-8"))
+    # For traced commands, the trace ID and the brick times at which the command was received, the wheels started and
+    # stopped, and the reply was sent are included so the server can measure the latency of each hop.
+    def sendDone(self, trace_id=None, received=None, started=None, finished=None):
+        if trace_id is None:
+            self.s.send("DONE".encode("UTF-8"))
+        else:
+            times = [received, started, finished, time.time()]
+            message = "DONE," + trace_id + "," + ",".join("%.6f" % t for t in times)
+            self.s.send(message.encode("UTF-8"))
 
     # Sends a message to the server letting it know that there was an isse during the execution of the movement (obstacle avoided) and that the initial jacobian should be recomputed (Visual servoing started from scratch)
     def sendReset(self):
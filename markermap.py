@@ -0,0 +1,118 @@
+# RUN ON LAPTOP USING PYTHON 3.6
+import math
+
+##### Map Parameters #############################################
+match_radius = 40  # cm (sightings closer than this to a known marker are treated as the same marker)
+visit_radius = 30  # cm (a marker counts as visited once the robot gets this close to it)
+default_leg_length = 60  # cm (assumed distance between markers when there is only one visited marker to go from)
+##################################################################
+
+
+# This class keeps a lightweight map of where markers were last seen, relative to the robot's dead-reckoned position.
+# The robot's pose is only updated from the commands sent to the brick (steering angle, duration and speed), using the
+# same bicycle model as calculateRotation in server.py. The map is used to turn straight towards the most likely
+# location of the next marker when no marker is visible, instead of blindly sweeping left and right.
+#
+# Coordinates are in cm, with y pointing forwards and x pointing to the right of the robot's starting pose.
+# Headings and bearings are in degrees, positive to the right, the same convention as vision.angle.
+class MarkerMap:
+    def __init__(self, wheelbase, max_speed_cm_per_sec):
+        self.wheelbase = wheelbase
+        self.max_speed_cm_per_sec = max_speed_cm_per_sec
+
+        # Dead-reckoned robot pose
+        self.x = 0.0
+        self.y = 0.0
+        self.heading = 0.0
+
+        self.target = None  # [x, y, color] of the marker currently being approached (seen but not yet visited)
+        self.visited = []   # [x, y, color] of the markers already visited, in order
+
+    # Updates the robot's pose after a command has been executed by the brick.
+    # Input:
+    #   steering_angle [Float]: Degrees the center axle was turned (positive to the right)
+    #   duration [Float]: Time in seconds the rear wheels were moving
+    #   speed [Integer]: Speed percentage of the rear wheels (negative when reversing)
+    def recordMove(self, steering_angle, duration, speed):
+        arc_length = (speed / 100.0) * self.max_speed_cm_per_sec * duration  # cm (negative when reversing)
+
+        # Change in heading along the arc (zero when going straight)
+        heading_change = math.degrees(arc_length * math.tan(math.radians(steering_angle)) / self.wheelbase)
+
+        # Move along the chord of the arc, which points halfway between the initial and final headings
+        if heading_change == 0:
+            chord_length = arc_length
+        else:
+            chord_length = 2 * arc_length * math.sin(math.radians(heading_change) / 2) / math.radians(heading_change)
+        chord_heading = math.radians(self.heading + heading_change / 2)
+        self.x += chord_length * math.sin(chord_heading)
+        self.y += chord_length * math.cos(chord_heading)
+        self.heading = normalizeAngle(self.heading + heading_change)
+
+        # Check if the robot has reached the marker it was approaching
+        if self.target is not None and self.distanceTo(self.target) <= visit_radius:
+            print(f"MAP: Visited {self.target[2]} marker #{len(self.visited) + 1}.")
+            self.visited.append(self.target)
+            self.target = None
+
+    # Records a marker sighting from the current pose.
+    # Input:
+    #   color [String]: Color of the marker
+    #   angle [Float]: Angle to the marker in degrees (vision.angle)
+    #   distance [Float]: Distance to the marker in cm (vision.distance)
+    def recordMarker(self, color, angle, distance):
+        bearing = math.radians(self.heading + angle)
+        marker_x = self.x + distance * math.sin(bearing)
+        marker_y = self.y + distance * math.cos(bearing)
+
+        # Ignore the markers that were already visited
+        for marker in self.visited:
+            if math.hypot(marker[0] - marker_x, marker[1] - marker_y) <= match_radius:
+                return
+
+        if self.target is not None and math.hypot(self.target[0] - marker_x, self.target[1] - marker_y) <= match_radius:
+            # Same marker seen again, so average out the dead reckoning and vision errors
+            self.target[0] = (self.target[0] + marker_x) / 2
+            self.target[1] = (self.target[1] + marker_y) / 2
+            self.target[2] = color
+        else:
+            self.target = [marker_x, marker_y, color]
+
+    # Estimates where the next marker is most likely to be.
+    # Output: (x, y) of the estimate, or None if the map does not know enough yet
+    def nextMarkerEstimate(self):
+        # A marker that was seen but not reached yet
+        if self.target is not None:
+            return self.target[0], self.target[1]
+
+        # Otherwise assume the course continues in the same direction as the last leg
+        if len(self.visited) >= 2:
+            (x_prev, y_prev, _), (x_last, y_last, _) = self.visited[-2:]
+            return 2 * x_last - x_prev, 2 * y_last - y_prev
+        if len(self.visited) == 1:
+            x_last, y_last, _ = self.visited[-1]
+            leg_x, leg_y = x_last, y_last  # Leg from the starting position
+            leg_length = math.hypot(leg_x, leg_y)
+            if leg_length == 0:
+                return None
+            scale = default_leg_length / leg_length
+            return x_last + leg_x * scale, y_last + leg_y * scale
+
+        return None
+
+    # Calculates the bearing from the robot to the most likely location of the next marker.
+    # Output: angle in degrees relative to the robot's heading (positive to the right), or None if unknown
+    def bearingToNextMarker(self):
+        estimate = self.nextMarkerEstimate()
+        if estimate is None:
+            return None
+        x, y = estimate
+        return normalizeAngle(math.degrees(math.atan2(x - self.x, y - self.y)) - self.heading)
+
+    def distanceTo(self, marker):
+        return math.hypot(marker[0] - self.x, marker[1] - self.y)
+
+
+# Wraps an angle in degrees to the range [-180, 180).
+def normalizeAngle(angle):
+    return (angle + 180) % 360 - 180
@@ -1,14 +1,18 @@
 #!/usr/bin/python
 # RUN ON LAPTOP USING PYTHON 3.6
 import time
+STARTUP_TIME = time.perf_counter()  # Used to report the time from launch to the first command sent to the brick
+import sys
 import math
 import socket
 import vision as vs
+import markermap as mm
+import tracing as tr
 from queue import Queue
 
 # This class handles the Server side of the communication between the laptop and the brick.
 class Server:
-    def __init__(self, host, port):
+    def __init__(self, host, port, tracer=None):
         # setup server socket
         serversocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         # We need to use the IP address that shows up in ipconfig for the USB ethernet adapter that handles the communication between the PC and the brick
@@ -19,6 +23,8 @@ class Server:
         serversocket.listen(5)
         self.cs, addr = serversocket.accept()
         print("Connected to: " + str(addr))
+        self.first_command_time = None  # Seconds from launch to the first command sent to the brick
+        self.tracer = tracer  # Records the latency of the traced commands (optional)
 
     # Sends set of commands to the brick via TCP.
     # Input:
@@ -26,14 +32,26 @@ class Server:
     #   duration [Float]: Time in seconds to move the rear wheels
     #   speed [Integer]: Speed percentage for the rear wheels (0 to 100)
     #   queue [Thread-safe Queue]: Mutable data structure to store (and return) the messages received from the client
-    def sendData(self, direction, duration, speed, queue):
-        # Format in which the client expects the data: "direction,duration,speed"
+    #   trace [Tuple]: Trace of the frame that produced the command, from LatencyTracer.takeDecision() (optional)
+    def sendData(self, direction, duration, speed, queue, trace=None):
+        # Format in which the client expects the data: "direction,duration,speed" or "direction,duration,speed,trace_id"
         data = f"{direction:.2f},{duration:.2f},{speed}"
+        if trace is not None:
+            data += f",{trace[0]}"
         print(f"\tSending Data: ({data}) to robot.")
+        send_time = time.time()
         self.cs.send(data.encode("UTF-8"))
+        if self.first_command_time is None:
+            self.first_command_time = time.perf_counter() - STARTUP_TIME
+            print(f"STARTUP: First command sent {self.first_command_time:.2f} seconds after launch.")
         # Waiting for the client (EV3 brick) to let the server know that it is done moving
         reply = self.cs.recv(128).decode("UTF-8")
-        queue.put(reply)
+        ack_time = time.time()
+        # Traced commands are acknowledged with "DONE,trace_id,received,started,finished,replied" (brick timestamps)
+        fields = reply.split(',')
+        if trace is not None and self.tracer is not None and len(fields) == 6 and fields[1] == str(trace[0]):
+            self.tracer.recordCommand(trace, send_time, [float(value) for value in fields[2:]], ack_time)
+        queue.put(fields[0])
 
     # Sends a termination message to the client. This will cause the client to exit "cleanly", after stopping the motors.
     def sendTermination(self):
@@ -51,10 +69,13 @@ class Server:
 
 host = "169.254.182.18"
 port = 9999
-server = Server(host, port)
 queue = Queue()
 
 STEREOVISION = True
+LATENCY_STATS_PATH = "latency_stats.json"  # Per-hop latency histograms, updated after every traced command
+ROI_DEPTH = True  # Use block matching around the marker for depth when only one camera matches it (stereo only)
+SKIP_RATE_REPORT_INTERVAL = 10  # seconds (how often to report the share of frames skipped by motion gating)
+VISION_READY_TIMEOUT = 15  # seconds (how often to warn while waiting for the tracker's first reading)
 MAX_STEERING_ANGLE = 35  # degrees
 MAX_MOTOR_SPEED = 1050  # degrees per second
 MAX_DURATION = 5  # seconds (max duration for turns to prevent overly long turns)   ##### Can actually be 2 theoretically. CHECK #####
@@ -71,14 +92,26 @@ WHEEL_CIRCUMFERENCE = math.pi * WHEEL_DIAMETER
 MAX_ROTATIONS_PER_SEC = MAX_MOTOR_SPEED / 360.0
 MAX_SPEED_CM_PER_SEC = WHEEL_CIRCUMFERENCE * MAX_ROTATIONS_PER_SEC
 
-vision = vs.Vision(stereo=STEREOVISION)
+# Map of where the markers were seen, used to turn towards the next marker when it is lost
+marker_map = mm.MarkerMap(WHEELBASE, MAX_SPEED_CM_PER_SEC)
+
+# Start the tracker first so that the cameras connect and decode their first frames while we wait for the brick
+vision = vs.Vision(stereo=STEREOVISION, roi_depth=ROI_DEPTH)
+tracer = tr.LatencyTracer(LATENCY_STATS_PATH)
+server = Server(host, port, tracer)
 print("Tracker Initializing...")
-time.sleep(5)  # Wait for the tracker to initialize
+# Keep the robot stopped until the tracker has produced its first reading
+while not vision.WaitUntilReady(timeout=VISION_READY_TIMEOUT):
+    if vision.failed:
+        # Never drive without a working tracker
+        print("ERROR: Tracker failed to start, stopping.")
+        sys.exit(1)
+    print("WARNING: Tracker is slow to start, still waiting for its first reading.")
 
 
-def calculateRotation(angle):
+def calculateRotation(angle, overshoot=1.5):
     # Rotate robot towards the marker
-    angle = angle * 1.5  # (Overshoot just in case it's a sharp turn)
+    angle = angle * overshoot  # (Overshoot just in case it's a sharp turn)
     speed = 25  # Slow speed to make the turn
     # Desired change in heading angle (Δϕ)
     desired_angle = angle
@@ -107,6 +140,18 @@ def calculateRotation(angle):
             duration = 0
     return desired_angle, steering_angle, duration, speed
 
+def moveRobot(direction, duration, speed):
+    # Let the tracker know that the frames will change, so it does not reuse its previous detections
+    vision.robot_moving = True
+    # Send command to robot, tagged with the frame that led to it
+    server.sendData(direction, duration, speed, queue, tracer.takeDecision())
+    # Wait for robot to complete the action
+    reply = queue.get()
+    print("\tRobot reply:", reply)
+    vision.robot_moving = False
+    # Keep track of where the robot is relative to the markers it has seen
+    marker_map.recordMove(direction, duration, speed)
+
 def rotateRobot(desired_angle, steering_angle, duration, speed, towards=True):
     if duration > 0:
         if towards:
@@ -117,11 +162,7 @@ def rotateRobot(desired_angle, steering_angle, duration, speed, towards=True):
             else:
                 print(f"ROTATE: Rotating robot by {desired_angle:.2f} degrees backwards over {duration:.2f} seconds.")
 
-        # Send command to robot
-        server.sendData(steering_angle, duration, speed, queue)
-        # Wait for robot to complete the action
-        reply = queue.get()
-        print("\tRobot reply:", reply)
+        moveRobot(steering_angle, duration, speed)
 
     else:
         print("Speed is zero or duration is zero, not moving.")
@@ -132,13 +173,20 @@ if __name__ == "__main__":
     checked_back = False
     checked_left = False
     checked_right = False
+    checked_map = False  # Whether the robot already turned towards the next marker's estimated location
+    reversed_by_map = False  # Whether that step already reversed the robot (so the sweep does not reverse again)
+    last_skip_rate_report = time.time()
 
     while True:
         print()
-        # Get vision data
-        angle = vision.angle
-        distance = vision.distance
-        color = vision.color
+        # Report how much segmentation the tracker saves by reusing its detections on unchanged frames
+        if time.time() - last_skip_rate_report >= SKIP_RATE_REPORT_INTERVAL:
+            last_skip_rate_report = time.time()
+            print(f"TRACKER: {vision.SkipRate() * 100:.1f}% of frames skipped by motion gating "
+                  f"({vision.frames_skipped} of {vision.frames_processed + vision.frames_skipped}).")
+        # Get vision data (readings and the trace of their frame are published together, so read them at once)
+        distance, angle, color, trace = vision.reading
+        tracer.readFrame(trace)
 
         # Determine speed
         if color == 'green':
@@ -150,12 +198,19 @@ if __name__ == "__main__":
         else:
             speed = 0  # Default to 0 speed
 
-        # Move robot
+        # Move robot (the command is chosen from the readings from here on)
+        tracer.decide()
         if angle is not None and color != 'red':
             # Marker detected, so reset checked_back, checked_left, and checked_right
             checked_back = False
             checked_left = False
             checked_right = False
+            checked_map = False
+            reversed_by_map = False
+
+            # Remember where the marker is
+            if color is not None and distance is not None:
+                marker_map.recordMarker(color, angle, distance)
             
             # Rotate the robot until robot is facing the marker
             if math.ceil(abs(angle)) > TOLERANCE or color is None:
@@ -189,20 +244,12 @@ if __name__ == "__main__":
 
                     print(f"MOVE: Moving forward {distance:.2f}cm at {speed*2}% speed for {duration:.2f} seconds.")
 
-                    # Send command to robot
-                    server.sendData(direction, duration, speed, queue)
-                    # Wait for robot to complete the action
-                    reply = queue.get()
-                    print("\tRobot reply:", reply)
+                    moveRobot(direction, duration, speed)
 
                 else:
                     if math.floor(distance) <= 0:
                         print(f"MOVE: Moving forward for 1 second to find next marker.")
-                        # Send command to robot
-                        server.sendData(direction, 1, 25, queue)
-                        # Wait for robot to complete the action
-                        reply = queue.get()
-                        print("\tRobot reply:", reply)
+                        moveRobot(direction, 1, 25)
                     print("ERROR: No valid distance, not moving.")
 
         else:
@@ -216,8 +263,29 @@ if __name__ == "__main__":
                 print("No marker detected.")
 
                 check_angle = 30
+                map_bearing = marker_map.bearingToNextMarker()
                 
-                if not checked_back and not checked_left and not checked_right:
+                if not checked_map and map_bearing is not None:
+                    # Turn straight towards where the next marker most likely is before sweeping blindly
+                    checked_map = True
+                    if abs(map_bearing) > 90:
+                        # The marker is behind, so turn by reversing (the nose swings towards it without driving past it)
+                        print(f"\tRobot is reversing to turn {map_bearing:.2f} degrees towards the next marker's last known location.")
+                        desired_angle, steering_angle, duration, speed = calculateRotation(map_bearing, overshoot=1)
+                        rotateRobot(desired_angle, -steering_angle, duration, -speed, towards=False)
+                    elif abs(map_bearing) > TOLERANCE:
+                        # Turn by exactly the bearing, since overshooting a large bearing would put the marker out of view
+                        print(f"\tRobot is turning {map_bearing:.2f} degrees towards the next marker's last known location.")
+                        desired_angle, steering_angle, duration, speed = calculateRotation(map_bearing, overshoot=1)
+                        rotateRobot(desired_angle, steering_angle, duration, speed)
+                    else:
+                        # The marker should be straight ahead, so it is most likely too close to be seen
+                        print("\tRobot is reversing to see the next marker at its last known location.")
+                        rotateRobot(0, 0, 2, -25, towards=False)
+                        # This was the sweep's reverse step, so carry on with checking left and right
+                        checked_back = True
+                        reversed_by_map = True
+                elif not checked_back and not checked_left and not checked_right:
                     # Reverse a little, then check left and right
                     checked_back = True
                     if STEREOVISION:
@@ -225,7 +293,7 @@ if __name__ == "__main__":
                         rotateRobot(0, 0, 2, -25, towards=False)
                 elif checked_back and not checked_left and not checked_right:
                     # Reverse then turn for single camera
-                    if not STEREOVISION:
+                    if not STEREOVISION and not reversed_by_map:
                         print("\tRobot is reversing to search for markers.")
                         rotateRobot(0, 0, 2, -25, towards=False)
                     # Check left side first
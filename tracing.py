@@ -0,0 +1,129 @@
+# RUN ON LAPTOP USING PYTHON 3.6
+import json
+import time
+from bisect import bisect_left
+
+##### Tracing Parameters #########################################
+bucket_edges = [10, 20, 50, 100, 200, 500, 1000, 2000, 5000]  # Upper edges of the histogram buckets in milliseconds
+hops = [
+    "read_to_measurement",         # Frame returned by the stream -> distance/angle/color computed
+    "measurement_to_decision",     # Readings computed -> controller decided to send a command
+    "decision_to_send",            # Decision -> command written to the socket
+    "send_to_brick_receive",       # Command sent -> command received by the brick (clock aligned)
+    "brick_receive_to_actuation",  # Command received -> rear wheels started (brick clock)
+    "actuation_to_finish",         # Rear wheels started -> rear wheels stopped (brick clock)
+    "finish_to_ack",               # Rear wheels stopped -> DONE received by the laptop (clock aligned)
+    "read_to_actuation",           # End to end: frame returned by the stream -> wheels moving (clock aligned)
+]
+##################################################################
+
+
+# This class follows each processed frame through the controller and the brick and keeps per-hop latency histograms.
+# Every frame gets a trace ID from the tracker (vision.reading), which is sent to the brick with the command it produced.
+# Frames are timestamped when the stream returns them, so the camera's own capture and buffering delay is not included.
+# The brick replies with its own timestamps, which are aligned to the laptop clock with an NTP-style offset estimate.
+# The histograms are written to a JSON file after every traced command.
+class LatencyTracer:
+    def __init__(self, path="latency_stats.json"):
+        self.path = path
+        self.pending = None  # Trace of the frame the controller is currently acting on
+        self.decision = None  # Pending trace with the time the controller decided what to do with it
+
+        # Histogram buckets: negative latencies (clock offset error on the aligned hops), then one per bucket edge, then
+        # the overflow bucket
+        self.histograms = {hop: [0] * (len(bucket_edges) + 2) for hop in hops}
+        self.counts = {hop: 0 for hop in hops}
+        self.totals = {hop: 0.0 for hop in hops}
+        self.maximums = {hop: None for hop in hops}
+
+        # Best estimate of (brick clock - laptop clock), from the exchange with the smallest network delay
+        self.clock_offset = None
+        self.clock_offset_delay = None
+
+    # Called when the controller reads the tracker's readings.
+    # Input:
+    #   trace [Tuple]: (trace_id, read_time, measurement_time) of the frame the readings come from (vision.reading)
+    def readFrame(self, trace):
+        self.pending = trace
+
+    # Called when the controller decides what to do with the readings it read last.
+    def decide(self):
+        if self.pending is None:
+            self.decision = None
+        else:
+            self.decision = self.pending + (time.time(),)
+        self.pending = None
+
+    # Called when a command is sent. The frame is only attributed to the first command sent after the decision.
+    # Output: (trace_id, read_time, measurement_time, decision_time), or None if there is no frame to attribute
+    def takeDecision(self):
+        decision = self.decision
+        self.decision = None
+        return decision
+
+    # Records the timestamps of a command once the brick has acknowledged it.
+    # Input:
+    #   trace [Tuple]: Trace returned by takeDecision()
+    #   send_time [Float]: Laptop time at which the command was sent
+    #   brick_times [List of Floats]: Brick times at which the command was received, the wheels started, the wheels
+    #                                 stopped and the acknowledgement was sent
+    #   ack_time [Float]: Laptop time at which the acknowledgement was received
+    def recordCommand(self, trace, send_time, brick_times, ack_time):
+        _, read_time, measurement_time, decision_time = trace
+        received, started, finished, replied = brick_times
+
+        # Clock offset estimate (same as NTP): the exchange with the smallest network delay gives the best estimate
+        delay = (ack_time - send_time) - (replied - received)
+        if self.clock_offset_delay is None or delay < self.clock_offset_delay:
+            self.clock_offset = ((received - send_time) + (replied - ack_time)) / 2
+            self.clock_offset_delay = delay
+
+        # Brick times on the laptop clock
+        received_laptop = received - self.clock_offset
+        started_laptop = started - self.clock_offset
+        finished_laptop = finished - self.clock_offset
+
+        self.recordHop("read_to_measurement", measurement_time - read_time)
+        self.recordHop("measurement_to_decision", decision_time - measurement_time)
+        self.recordHop("decision_to_send", send_time - decision_time)
+        self.recordHop("send_to_brick_receive", received_laptop - send_time)
+        self.recordHop("brick_receive_to_actuation", started - received)
+        self.recordHop("actuation_to_finish", finished - started)
+        self.recordHop("finish_to_ack", ack_time - finished_laptop)
+        self.recordHop("read_to_actuation", started_laptop - read_time)
+
+        self.export()
+
+    def recordHop(self, hop, seconds):
+        milliseconds = seconds * 1000
+        if milliseconds < 0:
+            # Only possible through clock offset error (up to half the round trip delay), so count it on its own and
+            # clamp it to zero for the mean and maximum
+            self.histograms[hop][0] += 1
+            milliseconds = 0.0
+        else:
+            self.histograms[hop][1 + bisect_left(bucket_edges, milliseconds)] += 1
+        self.counts[hop] += 1
+        self.totals[hop] += milliseconds
+        if self.maximums[hop] is None or milliseconds > self.maximums[hop]:
+            self.maximums[hop] = milliseconds
+
+    # Writes the per-hop latency histograms to the stats file.
+    def export(self):
+        labels = ["<0ms"] + [f"<={edge}ms" for edge in bucket_edges] + [f">{bucket_edges[-1]}ms"]
+        stats = {
+            "clock_offset_s": self.clock_offset,
+            "clock_offset_delay_s": self.clock_offset_delay,
+            "hops": {},
+        }
+        for hop in hops:
+            count = self.counts[hop]
+            stats["hops"][hop] = {
+                "count": count,
+                "mean_ms": self.totals[hop] / count if count else None,
+                "max_ms": self.maximums[hop],
+                "negative_count": self.histograms[hop][0],
+                "histogram": dict(zip(labels, self.histograms[hop])),
+            }
+        with open(self.path, "w") as stats_file:
+            json.dump(stats, stats_file, indent=2)
@@ -1,8 +1,11 @@
-import cv2
 import time
 import threading
 import numpy as np
 
+# OpenCV takes a while to import, so it is only loaded by the tracker thread when it is first needed (see LoadOpenCV).
+# This keeps "import vision" fast and lets the import overlap with the rest of the startup (e.g. waiting for the brick).
+cv2 = None
+
 ##### HSV Colour Ranges ##########################################
 # Red color ranges
 redLower1 = np.array([0, 120, 70])
@@ -27,47 +30,116 @@ largest_marker_radius = 80  # Largest detectable marker's radius
 distance_to_largest_marker_radius = 20  # In centimeters
 ##################################################################
 
+##### Camera Streams #############################################
+left_camera_url = "http://192.168.223.77:8080/video"    # Other phone
+right_camera_url = "http://192.168.223.249:8080/video"  # Maher's phone
+single_camera_url = "http://192.168.223.249:8080/video"  # Maher's phone
+##################################################################
+
+##### ROI Block Matching #########################################
+roi_min_depth = 0.30  # Closest marker depth in meters the block matching has to reach
+# Disparity search range in pixels, rounded up to a multiple of 16 (176 px for 30 cm)
+roi_num_disparities = int(np.ceil(focal_length * baseline / roi_min_depth / 16)) * 16
+roi_alias_margin = 8  # Medians within this many pixels of the search range are likely aliased and rejected
+roi_block_size = 15  # Size of the matched blocks in pixels (must be odd)
+roi_min_valid_fraction = 0.05  # Minimum fraction of the window with a valid disparity to trust the median
+##################################################################
+
+##### Motion Gating ##############################################
+thumbnail_size = (32, 24)  # Size of the downsampled (colour) copy of the frames used to detect changes in the scene
+change_threshold = 25  # Largest difference in any cell and colour channel above which the scene is considered changed
+max_reuse_time = 0.5  # Seconds after which the frames are fully processed again even if nothing seems to have changed
+##################################################################
+
+
+# Imports OpenCV the first time it is needed and makes it available to the rest of the module.
+def LoadOpenCV():
+    global cv2
+    if cv2 is None:
+        import cv2 as opencv
+        cv2 = opencv
+    return cv2
+
 
 class Vision:
     
-    def __init__(self, stereo):
+    def __init__(self, stereo, roi_depth=False):
         self.distance = None
         self.angle = None
         self.color = None
 
+        # When enabled, markers that are only matched by one camera (or clipped at the frame edge) get their depth
+        # from stereo block matching in a small window around the marker instead of falling back to a fixed angle.
+        self.roi_depth = roi_depth
+        self.block_matcher = None
+
+        # Readiness of the tracker. The event is set once the first frame has been processed, or once the tracker
+        # has stopped without producing a reading (e.g. OpenCV or a camera could not be opened), in which case
+        # failed is True and ready_time stays None.
+        self.ready = threading.Event()
+        self.start_time = time.perf_counter()
+        self.ready_time = None  # Seconds from creating the tracker to its first processed frame
+        self.failed = False
+
+        # Motion gating. While the robot is standing still (set by the controller) and the scene does not change,
+        # the previous detections are reused instead of segmenting every frame again.
+        self.robot_moving = False
+        self.timestamp = None  # Time at which the readings were last updated
+        self.reference_thumbnails = None  # Downsampled copies of the frames the current detections come from
+        self.reference_time = None  # Time at which the current detections were computed
+        self.frames_processed = 0
+        self.frames_skipped = 0
+
+        # Latency tracing. Every processed frame gets a trace ID. The readings are published together with the trace
+        # of their frame as one (distance, angle, color, trace) tuple, where trace is (trace_id, read_time,
+        # measurement_time), so the controller can read both at once. read_time is taken when the frame is returned
+        # by the stream, so it does not include the camera's own capture and buffering delay.
+        self.frame_count = 0
+        self.reading = (None, None, None, None)
+
         # self.TrackerThread(stereo)  # Use this instead of the threading code below if on macOS if you want to see camera view
         thread = threading.Thread(target=self.TrackerThread, args=(stereo,), daemon=True)
         thread.start()
         
     def TrackerThread(self, stereo):
+        try:
+            self.RunTracker(stereo)
+        finally:
+            # Release anyone waiting on the tracker if it stopped (or crashed) before producing a reading
+            if self.ready_time is None:
+                self.failed = True
+            self.ready.set()
+
+    def RunTracker(self, stereo):
         print("Tracker Started")
+        LoadOpenCV()
+        if stereo and self.roi_depth:
+            self.block_matcher = cv2.StereoBM_create(numDisparities=roi_num_disparities, blockSize=roi_block_size)
         # Check is user wants to use stereo vision or single camera
         if stereo:
-            # Get the cameras
-            vc_left = cv2.VideoCapture("http://192.168.223.77:8080/video")   # Other phone
-            vc_right = cv2.VideoCapture("http://192.168.223.249:8080/video")  # Maher's phone
-
-            # Set frame rates
-            vc_left.set(cv2.CAP_PROP_FPS, 30)
-            vc_right.set(cv2.CAP_PROP_FPS, 30)
+            # Get the cameras and their first frames (both cameras are connected to in parallel)
+            (vc_left, rval_left, frame_left), (vc_right, rval_right, frame_right) = \
+                self.OpenCameras([left_camera_url, right_camera_url], fps=30)
             
-            # Try to get the first frames
-            if vc_left.isOpened() and vc_right.isOpened():
-                rval_left, frame_left = vc_left.read()
-                rval_right, frame_right = vc_right.read()
-            else:
+            if not (rval_left and rval_right):
                 print("\t\tERROR: Could not open video streams")
                 rval_left = False
                 rval_right = False
             
+            roi_disparities = {}  # Block matching results for the current detections, reused along with them
+            
             while rval_left and rval_right:
                 # Get the frames
                 rval_left, frame_left = vc_left.read()
                 rval_right, frame_right = vc_right.read()
+                read_time = time.time()
+                self.frame_count += 1
                 
-                # Process the frames
-                circle_left, color_left = self.GetLocation(frame_left)     # Left frame
-                circle_right, color_right = self.GetLocation(frame_right)  # Right frame
+                # Process the frames (or reuse the previous detections if nothing changed)
+                if self.FramesChanged([frame_left, frame_right]):
+                    circle_left, color_left = self.GetLocation(frame_left)     # Left frame
+                    circle_right, color_right = self.GetLocation(frame_right)  # Right frame
+                    roi_disparities = {}
                 
                 # Draw the detected circles
                 self.DrawCircle(frame_left, circle_left, color_left)
@@ -175,7 +247,36 @@ class Vision:
                     else:
                         self.angle = None  # No markers detected in either frame
 
-                    if self.angle is not None:
+                    # Try to get the depth of the favored marker by block matching around it in both frames
+                    if self.roi_depth and self.angle is not None:
+                        if self.angle > 0:
+                            circle, color, in_left = circle_right, color_right, False
+                        else:
+                            circle, color, in_left = circle_left, color_left, True
+                        if in_left not in roi_disparities:
+                            roi_disparities[in_left] = self.RoiDisparity(frame_left, frame_right, circle, in_left)
+                        disparity = roi_disparities[in_left]
+                        if disparity is not None:
+                            # Position of the marker in the other frame
+                            if in_left:
+                                x_left, x_right = circle[0], circle[0] - disparity
+                            else:
+                                x_left, x_right = circle[0] + disparity, circle[0]
+                            self.color = color
+                            self.StereoVision(frame_width_left / 2, x_left, x_right)
+
+                    if self.distance is not None and self.angle is not None and self.color is not None:
+                        # Overlay the block matching readings on the frames
+                        for frame in (frame_left, frame_right):
+                            cv2.putText(frame, "Same marker not detected in both frames (ROI depth)", (10, 30),
+                                        cv2.FONT_HERSHEY_SIMPLEX, 0.7, (0, 255, 255), 2)
+                            cv2.putText(frame, f"Distance: {self.distance:.2f} cm", (10, 60),
+                                        cv2.FONT_HERSHEY_SIMPLEX, 0.7, (0, 255, 255), 2)
+                            cv2.putText(frame, f"Angle: {self.angle:.2f} deg", (10, 90),
+                                        cv2.FONT_HERSHEY_SIMPLEX, 0.7, (0, 255, 255), 2)
+                            cv2.putText(frame, f"Color: {self.color}", (10, 120),
+                                        cv2.FONT_HERSHEY_SIMPLEX, 0.7, (0, 255, 255), 2)
+                    elif self.angle is not None:
                         # Overlay the instruction on the frames
                         cv2.putText(frame_left, "Same marker not detected in both frames", (10, 30),
                                     cv2.FONT_HERSHEY_SIMPLEX, 0.7, (0, 0, 255), 2)
@@ -188,6 +289,12 @@ class Vision:
                                     cv2.FONT_HERSHEY_SIMPLEX, 0.7, (0, 0, 255), 2)
 
                 
+                self.timestamp = time.time()  # The readings are up to date as of this frame (even if reused)
+                self.reading = (self.distance, self.angle, self.color, (self.frame_count, read_time, self.timestamp))
+                
+                # The first frames have been processed, so the readings can now be used
+                self.SetReady()
+                
                 # Display the result (Does not work on macOS with threading. So comment out for macOS, uncomment for Windows)
                 cv2.imshow("Left Camera", frame_left)
                 cv2.imshow("Right Camera", frame_right)
@@ -202,21 +309,21 @@ class Vision:
             print("Tracker Ended")
         
         else:
-            vc = cv2.VideoCapture("http://192.168.223.249:8080/video")  # Maher's phone
+            # Get the camera and its first frame
+            [(vc, rval, frame)] = self.OpenCameras([single_camera_url])
             
-            # Try to get the first frames
-            if vc.isOpened():
-                rval, frame = vc.read()
-            else:
+            if not rval:
                 print("\t\tERROR: Could not open video stream")
-                rval = False
             
             while rval:
                 # Get the frame
                 rval, frame = vc.read()
+                read_time = time.time()
+                self.frame_count += 1
                 
-                # Process the frame
-                circle, color = self.GetLocation(frame)
+                # Process the frame (or reuse the previous detection if nothing changed)
+                if self.FramesChanged([frame]):
+                    circle, color = self.GetLocation(frame)
                 
                 # Draw the detected circle
                 self.DrawCircle(frame, circle, color)
@@ -246,6 +353,12 @@ class Vision:
                     self.angle = None
                     self.color = None
                 
+                self.timestamp = time.time()  # The readings are up to date as of this frame (even if reused)
+                self.reading = (self.distance, self.angle, self.color, (self.frame_count, read_time, self.timestamp))
+                
+                # The first frame has been processed, so the readings can now be used
+                self.SetReady()
+                
                 # Display the result (Does not work on macOS with threading. So comment out for macOS, uncomment for Windows)
                 cv2.imshow("Camera", frame)
                 
@@ -257,6 +370,125 @@ class Vision:
             cv2.destroyAllWindows()
             print("Tracker Ended")
     
+    # Connects to the given camera streams in parallel and reads the first frame of each one.
+    # Input:
+    #   urls [List of Strings]: Addresses of the video streams
+    #   fps [Integer]: Frame rate to request from the cameras (None to keep the default)
+    # Output: list with a (capture, rval, frame) tuple per stream, in the same order as urls
+    def OpenCameras(self, urls, fps=None):
+        cameras = [None] * len(urls)
+
+        def open_camera(index, url):
+            vc = cv2.VideoCapture(url)
+            if fps is not None:
+                vc.set(cv2.CAP_PROP_FPS, fps)
+            if vc.isOpened():
+                rval, frame = vc.read()
+            else:
+                rval, frame = False, None
+            cameras[index] = (vc, rval, frame)
+
+        threads = [threading.Thread(target=open_camera, args=(index, url), daemon=True) for index, url in enumerate(urls)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return cameras
+
+    # Estimates the disparity of a marker by running stereo block matching only in a small window around it.
+    # Input:
+    #   frame_left, frame_right [Images]: Latest frames of the left and right cameras
+    #   circle [Array]: (x, y, radius) of the marker in the frame it was detected in
+    #   in_left [Boolean]: True if the circle was detected in the left frame, False if in the right frame
+    # Output: median disparity in pixels over the pixels of the marker, or None if there are not enough valid matches
+    def RoiDisparity(self, frame_left, frame_right, circle, in_left):
+        x, y, radius = circle
+        frame_height, frame_width = frame_left.shape[:2]
+        half_size = int(radius) + roi_block_size // 2  # Marker plus half a block, so its edges can be matched
+
+        # The matcher needs roi_num_disparities extra columns to search in, on the left of the marker in the left
+        # frame, or on the right of the marker in the right frame (a point at x in the right frame is at x + disparity
+        # in the left frame)
+        top = max(int(y) - half_size, 0)
+        bottom = min(int(y) + half_size + 1, frame_height)
+        if in_left:
+            left = max(int(x) - half_size - roi_num_disparities, 0)
+            right = min(int(x) + half_size + 1, frame_width)
+        else:
+            left = max(int(x) - half_size, 0)
+            right = min(int(x) + half_size + 1 + roi_num_disparities, frame_width)
+        if bottom - top < roi_block_size or right - left <= roi_num_disparities + roi_block_size:
+            return None
+
+        gray_left = cv2.cvtColor(frame_left[top:bottom, left:right], cv2.COLOR_BGR2GRAY)
+        gray_right = cv2.cvtColor(frame_right[top:bottom, left:right], cv2.COLOR_BGR2GRAY)
+        if in_left:
+            reference, other = gray_left, gray_right
+            x_marker = x - left
+        else:
+            # Match in right image coordinates: mirrored, the right frame becomes the left one and vice versa
+            reference, other = cv2.flip(gray_right, 1), cv2.flip(gray_left, 1)
+            x_marker = (right - 1) - x
+        disparity = self.block_matcher.compute(reference, other).astype(np.float32) / 16.0  # Fixed point to pixels
+
+        # Only keep the pixels inside the detected circle (the first columns have no full search range)
+        rows, columns = np.ogrid[:bottom - top, :right - left]
+        inside = ((columns - x_marker) ** 2 + (rows - (y - top)) ** 2 <= radius ** 2) & (columns >= roi_num_disparities)
+        valid = disparity[inside & (disparity > 0)]
+        if valid.size == 0 or valid.size < roi_min_valid_fraction * np.count_nonzero(inside):
+            return None
+        median = float(np.median(valid))
+        if median >= roi_num_disparities - roi_alias_margin:
+            return None  # At the end of the search range, so the marker is probably closer than roi_min_depth
+        return median
+
+    # Cheap change detector used to skip the segmentation while the robot and the scene are still.
+    # Input:
+    #   frames [List of Images]: Latest frame of each camera
+    # Output: True if the frames need to be processed, False if the previous detections can be reused
+    def FramesChanged(self, frames):
+        # Colour thumbnails, so that a marker changing colour is noticed even if its brightness barely changes
+        thumbnails = [cv2.resize(frame, thumbnail_size, interpolation=cv2.INTER_AREA) for frame in frames]
+        now = time.time()
+
+        changed = (self.robot_moving or self.reference_thumbnails is None or
+                   now - self.reference_time > max_reuse_time)
+        if not changed:
+            # Look at the largest change in any single cell, since a marker only covers a small part of the frame
+            for thumbnail, reference in zip(thumbnails, self.reference_thumbnails):
+                if np.max(cv2.absdiff(thumbnail, reference)) > change_threshold:
+                    changed = True
+                    break
+
+        if changed:
+            self.reference_thumbnails = thumbnails
+            self.reference_time = now
+            self.frames_processed += 1
+        else:
+            self.frames_skipped += 1
+        return changed
+
+    # Output: fraction of the frames for which the segmentation was skipped
+    def SkipRate(self):
+        total = self.frames_processed + self.frames_skipped
+        if total == 0:
+            return 0.0
+        return self.frames_skipped / total
+
+    # Marks the tracker as ready the first time it is called and reports how long the startup took.
+    def SetReady(self):
+        if not self.ready.is_set():
+            self.ready_time = time.perf_counter() - self.start_time
+            print(f"Tracker Ready ({self.ready_time:.2f} seconds after start)")
+            self.ready.set()
+
+    # Blocks until the tracker has processed its first frame.
+    # Input:
+    #   timeout [Float]: Maximum time in seconds to wait (None to wait forever)
+    # Output: True if the tracker is ready, False if it timed out or failed (see self.failed to tell them apart)
+    def WaitUntilReady(self, timeout=None):
+        return self.ready.wait(timeout) and self.ready_time is not None
+    
     def StereoVision(self, c_x, x_left, x_right):        
         disparity = abs(x_left - x_right)  # In pixels
         
@@ -293,7 +525,7 @@ class Vision:
         if (x - radius < margin or x + radius > frame_width - margin):
             if round(radius) < 55:
                 self.distance = None
-                self.color = radius
+                self.color = None  # No distance for a clipped marker, so the controller only turns towards it
                 if x - c_x > tolerance:
                     self.angle = 20
                 elif x - c_x < -tolerance:
@@ -304,7 +536,7 @@ class Vision:
         if (y - radius < margin or y + radius > frame_height - margin):
             if round(radius) < 65:
                 self.distance = None
-                self.color = radius
+                self.color = None  # No distance for a clipped marker, so the controller only turns towards it
                 if x - c_x > 0:
                     self.angle = 20
                 elif x - c_x < 0:
@@ -409,7 +641,10 @@ class Vision:
 if __name__ == "__main__":
     vision = Vision(stereo=True)
     print("Tracker Initializing...")
-    time.sleep(5)  # Wait for the tracker to initialize
+    if not vision.WaitUntilReady(timeout=15):
+        if vision.failed:
+            raise SystemExit("\t\tERROR: Tracker failed to start.")
+        print("\t\tERROR: Tracker is not ready.")
     
     while True:
         # Output the distance, angle, and color
@@ -424,4 +659,5 @@ if __name__ == "__main__":
         
         else:
             print("\t\tERROR: No markers detected.")
+        print(f"Frames skipped by motion gating: {vision.SkipRate() * 100:.1f}%")
         time.sleep(1)